@@ -1,15 +1,34 @@
 import os
 import re
 import json
+import hashlib
+import io
+import uuid
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# OCR pages already run in parallel; keep each Tesseract instance single-threaded so they don't oversubscribe cores.
+# Must be set before tesserocr loads libtesseract/OpenMP.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 import streamlit as st
-import pdfplumber
-import pytesseract
+import pymupdf
+from tesserocr import PyTessBaseAPI, PSM, OEM
 from PIL import Image
+import numpy as np
 import pandas as pd
-import requests
-from bs4 import BeautifulSoup
+import httpx
+import json_repair
+import tiktoken
+import diskcache
+import openai
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.dataset as ds
+from selectolax.lexbor import LexborHTMLParser
 
 # -------------- Streamlit Page Setup --------------
 st.set_page_config(
@@ -81,128 +100,1142 @@ if not api_key:
     st.error("Set your OpenAI key as env var OPENAI_API_KEY or in Streamlit secrets as `openai_api_key`.")
     st.stop()
 
+@st.cache_resource
+def get_openai_client(api_key: str) -> openai.OpenAI:
+    # Built once per key rather than on every rerun, so its HTTP connection pool is reused.
+    # Retries are handled by _openai_retry below, so the SDK's own retry loop is disabled.
+    return openai.OpenAI(api_key=api_key, max_retries=0, timeout=60.0)
+
 try:
-    from openai import OpenAI
-    client = OpenAI(api_key=api_key)
+    client = get_openai_client(api_key)
 except Exception as e:
     st.error(f"OpenAI client import/init failed: {e}")
     st.stop()
 
+# Exponential backoff with jitter (about 1s, 2s, 4s, 8s... capped at 60s) on rate limits, timeouts,
+# dropped connections and 5xx responses. Every API call goes through it, as a decorator or a wrapper.
+_openai_retry = retry(
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)),
+    reraise=True,
+)
+# Hold back the next call once less than this share of the per-window request budget remains.
+RATE_LIMIT_HEADROOM = 0.05
+# Reset durations in rate-limit headers look like "1s", "6m0s" or "120ms".
+_RESET_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_RESET_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limit_state() -> dict:
+    # Earliest time.monotonic() at which the next API request may be sent, shared by every session.
+    return {"not_before": 0.0}
+
+def _wait_for_rate_limit() -> None:
+    delay = get_rate_limit_state()["not_before"] - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+def _note_rate_limit(headers) -> None:
+    try:
+        limit = int(headers.get("x-ratelimit-limit-requests", 0))
+        remaining = int(headers.get("x-ratelimit-remaining-requests", limit))
+    except ValueError:
+        return
+    if limit and remaining < limit * RATE_LIMIT_HEADROOM:
+        reset = headers.get("x-ratelimit-reset-requests", "")
+        wait = min(60, sum(float(n) * _RESET_UNITS[unit] for n, unit in _RESET_RE.findall(reset)))
+        state = get_rate_limit_state()
+        state["not_before"] = max(state["not_before"], time.monotonic() + wait)
+
+@_openai_retry
+def _chat(**params):
+    """
+    chat.completions.create with retries; also works with stream=True (the stream object is returned).
+    """
+    _wait_for_rate_limit()
+    raw = client.chat.completions.with_raw_response.create(**params)
+    _note_rate_limit(raw.headers)
+    return raw.parse()
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+@_openai_retry
+def _embed(texts: list[str]) -> list[list[float]]:
+    _wait_for_rate_limit()
+    raw = client.embeddings.with_raw_response.create(model=EMBEDDING_MODEL, input=texts)
+    _note_rate_limit(raw.headers)
+    return [d.embedding for d in raw.parse().data]
+
 # -------------- Helpers --------------
-def extract_text_with_ocr(uploaded_file) -> str:
+# First 6-10 digit run in a model answer; its first 6 digits are the HTS subheading.
+_HTS_RE = re.compile(r"\b\d{6,10}\b")
+# Dots/spaces in a printed code ("8471.30.00"), and the 6-10 digits a code starts with once they are removed.
+_HTS_SEPARATOR_RE = re.compile(r"[.\s]")
+_HTS_DIGITS_RE = re.compile(r"\d{6,10}")
+# Pages with fewer selectable/OCR characters than this are treated as (near) empty.
+MIN_PAGE_TEXT_CHARS = 30
+# Invoices are printed text, so OCR at 200 DPI first and only re-render at 300 DPI when that comes back near-empty.
+OCR_DPI = 200
+OCR_RETRY_DPI = 300
+# First-pass pages are thresholded to pure black/white at this gray level; the 300 DPI retry keeps grayscale
+# so Tesseract's own adaptive thresholding gets a go at faint scans.
+OCR_BINARIZE_THRESHOLD = 155
+# Separates pages in extracted text so long invoices can be split for extraction on page boundaries.
+PAGE_SEPARATOR = "\n\f"
+_BINARIZE_LUT = [0] * OCR_BINARIZE_THRESHOLD + [255] * (256 - OCR_BINARIZE_THRESHOLD)
+
+@st.cache_resource
+def get_ocr_executor() -> ThreadPoolExecutor:
+    # Long-lived workers so each keeps its Tesseract model loaded across pages and reruns.
+    return ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="ocr")
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def extract_text_with_ocr(pdf_bytes: bytes) -> str:
     """
-    Extract text from a PDF; if a page has little/no text, OCR it.
+    Extract text from a PDF; if a page has little/no text, OCR it. Cached on the file bytes, so reruns
+    (downloads, button clicks) and re-uploads of the same invoice skip the OCR.
     """
-    all_text = ""
-    with pdfplumber.open(uploaded_file) as pdf:
-        for i, page in enumerate(pdf.pages, start=1):
+    page_texts = []
+    ocr_jobs = {}  # page number -> OCR future
+    # One PyMuPDF pass provides both the text layer and, for pages without one, the raster for OCR.
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for i, page in enumerate(doc, start=1):
             try:
-                text = page.extract_text() or ""
+                text = page.get_text("text", sort=True) or ""
             except Exception as e:
                 text = ""
 
-            if text.strip() and len(text.strip()) > 30:
-                all_text += text + "\n"
+            if not needs_ocr(page, text):
+                page_texts.append(text)
                 continue
 
-            # Fallback to OCR
+            # Fallback to OCR; each page is queued as soon as it is rendered, so OCR overlaps rendering the rest.
             st.warning(f"Page {i} had little/no selectable text. Using OCR.")
+            page_texts.append("")
             try:
-                # Render page raster for OCR; to_image may require wand/ImageMagick
-                pil_img = page.to_image(resolution=300).original  # may raise if wand/imagemagick missing
-                ocr_text = pytesseract.image_to_string(pil_img) or ""
-                all_text += ocr_text + "\n"
+                ocr_jobs[i] = get_ocr_executor().submit(
+                    _ocr_image, _render_page(doc, i, OCR_DPI).point(_BINARIZE_LUT), OCR_DPI
+                )
             except Exception as e:
-                st.error(
-                    f"OCR render failed on page {i}. Ensure ImageMagick/Wand is installed. Error: {e}"
+                st.error(f"Rendering page {i} for OCR failed. Error: {e}")
+
+        retry_jobs = {}
+        # Page images are only referenced by their queued OCR task, so each is freed as soon as it has been read.
+        progress = st.progress(0.0, text="Running OCR...") if ocr_jobs else None
+        for done, (i, future) in enumerate(ocr_jobs.items(), start=1):
+            progress.progress(done / len(ocr_jobs), text=f"OCR: page {i} ({done} of {len(ocr_jobs)})")
+            try:
+                page_texts[i - 1] = future.result() or ""
+            except Exception as e:
+                st.error(f"OCR failed on page {i}. Ensure Tesseract is installed. Error: {e}")
+                continue
+            if len(page_texts[i - 1].strip()) <= MIN_PAGE_TEXT_CHARS:
+                retry_jobs[i] = get_ocr_executor().submit(
+                    _ocr_image, _render_page(doc, i, OCR_RETRY_DPI), OCR_RETRY_DPI
                 )
-    return all_text
 
-def ai_extract_invoice_data(pdf_text: str) -> str:
+        for i, future in retry_jobs.items():
+            try:
+                result = future.result() or ""
+            except Exception:
+                continue
+            if len(result.strip()) > len(page_texts[i - 1].strip()):
+                page_texts[i - 1] = result
+    if progress is not None:
+        progress.empty()
+    return PAGE_SEPARATOR.join(page_texts)
+
+def needs_ocr(page: pymupdf.Page, text: str) -> bool:
     """
-    Ask the model to extract invoice header + line items and return JSON (as text).
+    True when a page has too little selectable text and something OCR could read: an embedded image or vector
+    drawing (outlined text). Blank pages are skipped without rendering.
+    """
+    if len(text.strip()) > MIN_PAGE_TEXT_CHARS:
+        return False
+    try:
+        return bool(page.get_image_info() or page.get_drawings())
+    except Exception:
+        return True
+
+def _render_page(doc: pymupdf.Document, page_number: int, dpi: int) -> Image.Image:
+    # Tesseract binarizes grayscale anyway, so skip colour: a third of the pixels to render and hold in memory.
+    pix = doc[page_number - 1].get_pixmap(dpi=dpi, colorspace=pymupdf.csGRAY)
+    return Image.frombytes("L", [pix.width, pix.height], pix.samples)
+
+@st.cache_resource(show_spinner=False)
+def get_tesseract_local() -> threading.local:
+    return threading.local()
+
+def _tesseract_api() -> PyTessBaseAPI:
+    # PyTessBaseAPI is not thread-safe, so every OCR worker thread gets its own instance.
+    local = get_tesseract_local()
+    api = getattr(local, "api", None)
+    if api is None:
+        # LSTM engine + single uniform text block: skips full page layout analysis on tabular invoices.
+        api = PyTessBaseAPI(psm=PSM.SINGLE_BLOCK, oem=OEM.LSTM_ONLY)
+        api.SetVariable("preserve_interword_spaces", "1")
+        local.api = api
+    return api
+
+def _ocr_image(image: Image.Image, dpi: int) -> str:
+    api = _tesseract_api()
+    # Hand over the raw 8-bit pixels, one byte per pixel.
+    api.SetImageBytes(image.tobytes(), image.width, image.height, 1, image.width)
+    api.SetSourceResolution(dpi)
+    return api.GetUTF8Text()
+
+# hts_6 is the model's HTS guess, made while it has the whole invoice in context; see inline_hts_codes.
+LINE_ITEM_FIELDS = (
+    "invoice_number", "invoice_date", "description", "part_number",
+    "brand", "quantity", "price", "extended_price", "hts_6",
+)
+INVOICE_SCHEMA = {
+    "name": "invoice",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {field: {"type": "string"} for field in LINE_ITEM_FIELDS},
+                    "required": list(LINE_ITEM_FIELDS),
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["items"],
+        "additionalProperties": False,
+    },
+}
+
+STREAM_RENDER_EVERY = 8  # stream deltas per preview re-render
+STREAM_PREVIEW_CHARS = 1500
+
+def extraction_request(pdf_text: str) -> dict:
+    """
+    Chat completion parameters for extracting line items from invoice text (shared by the realtime and Batch API paths).
     """
     prompt = (
-        "Extract the following from this invoice text:\n"
-        "- Invoice Number\n"
-        "- Invoice Date\n"
-        "- Vendor\n"
-        "- For each line item: item/manufacturer part number, description, brand, quantity, price, extended price.\n"
-        "Return ONLY a JSON array of line item objects. Each object must include the invoice number and invoice date.\n"
+        "Extract every line item from this invoice text: item/manufacturer part number, description, brand, "
+        "quantity, price and extended price. Each line item must also carry the invoice number and invoice date.\n"
+        "Set hts_6 to the most likely 6-digit US HTS code for the item (digits only).\n"
         "If a field is unknown, set it to an empty string.\n\n"
         f"Text:\n{pdf_text}"
     )
-    resp = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
             {"role": "system", "content": "You are an expert at understanding invoices and producing strict JSON."},
             {"role": "user", "content": prompt},
         ],
-        temperature=0
-    )
-    return resp.choices[0].message.content or ""
+        "response_format": {"type": "json_schema", "json_schema": INVOICE_SCHEMA},
+        "temperature": 0,
+    }
+
+# Invoice text above this many tokens is extracted in page-aligned chunks, one concurrent request per chunk.
+EXTRACTION_CHUNK_TOKENS = 6000
+# Upper bound on concurrent extraction requests for one invoice.
+EXTRACTION_MAX_WORKERS = 4
+
+@st.cache_resource(show_spinner=False)
+def get_token_encoding() -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model("gpt-4o-mini")
+
+def chunk_invoice_text(pdf_text: str) -> list[str]:
+    """
+    Group consecutive pages into chunks of at most EXTRACTION_CHUNK_TOKENS tokens. A page is never split,
+    so a single page over the limit becomes a chunk on its own.
+    """
+    encoding = get_token_encoding()
+    chunks, current, current_tokens = [], [], 0
+    for page in pdf_text.split(PAGE_SEPARATOR):
+        page_tokens = len(encoding.encode(page, disallowed_special=()))
+        if current and current_tokens + page_tokens > EXTRACTION_CHUNK_TOKENS:
+            chunks.append(PAGE_SEPARATOR.join(current))
+            current, current_tokens = [], 0
+        current.append(page)
+        current_tokens += page_tokens
+    chunks.append(PAGE_SEPARATOR.join(current))
+    return chunks
 
-def ai_predict_hts(description: str, part_number: str) -> str:
+@st.cache_data(ttl=86400, show_spinner=False)
+def ai_extract_invoice_data(pdf_text: str) -> list[dict]:
     """
-    Ask the model for the likely 6-digit HTS code. Returns 6 digits when possible.
+    Ask the model to extract invoice header + line items. Returns one dict per line item with LINE_ITEM_FIELDS keys.
+    Cached on the text, so a rerun does not repeat the model call.
     """
+    chunks = chunk_invoice_text(pdf_text)
+    if len(chunks) == 1:
+        return _stream_extraction(pdf_text)
+
+    results, prefetched = [], set()
+    with ThreadPoolExecutor(max_workers=min(len(chunks), EXTRACTION_MAX_WORKERS)) as executor:
+        for chunk_items in executor.map(_extract_chunk, chunks):
+            prefetch_tariffs(chunk_items, prefetched)
+            results.append(chunk_items)
+    items = [item for chunk_items in results for item in chunk_items]
+    # A header usually sits on an invoice's first page only, and a PDF can hold several invoices, so blanks take
+    # the most recent header before them; only leading blanks fall back to the first header in the document.
+    for field in ("invoice_number", "invoice_date"):
+        last = next((item[field] for item in items if item[field]), "")
+        for item in items:
+            if item[field]:
+                last = item[field]
+            else:
+                item[field] = last
+    return items
+
+def _extract_chunk(pdf_text: str) -> list[dict]:
+    message = _chat(**extraction_request(pdf_text)).choices[0].message
+    if message.refusal:
+        raise ValueError(f"Model refused the extraction: {message.refusal}")
+    return parse_line_items(message.content)
+
+def _stream_extraction(pdf_text: str) -> list[dict]:
+    stream = _chat(**extraction_request(pdf_text), stream=True)
+    # Show the JSON as it arrives, re-rendering only every few deltas to avoid a rerender per token.
+    placeholder = st.empty()
+    content, refusal = [], []
+    # Tariff lookups for items whose JSON has fully arrived start while the rest is still being generated.
+    resume_at, prefetched = None, set()
+    for n, chunk in enumerate(stream, start=1):
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content.append(delta.content)
+        if delta.refusal:
+            refusal.append(delta.refusal)
+        if n % STREAM_RENDER_EVERY == 0:
+            text = "".join(content)
+            placeholder.code(text[-STREAM_PREVIEW_CHARS:], language="json")
+            items, resume_at = _streamed_items(text, resume_at)
+            prefetch_tariffs(items, prefetched)
+    placeholder.empty()
+    if refusal:
+        raise ValueError(f"Model refused the extraction: {''.join(refusal)}")
+    return parse_line_items("".join(content))
+
+_JSON_DECODER = json.JSONDecoder()
+
+def _streamed_items(text: str, pos: int | None) -> tuple[list[dict], int | None]:
+    """
+    Line items whose JSON has fully arrived in a partial extraction answer, read from pos (None until the items
+    array has opened). Returns them with the position to resume from on the next call.
+    """
+    if pos is None:
+        start = text.find("[")
+        if start < 0:
+            return [], None
+        pos = start + 1
+    items = []
+    while True:
+        while pos < len(text) and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(text) or text[pos] != "{":
+            return items, pos
+        try:
+            item, pos_after = _JSON_DECODER.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            return items, pos
+        items.append(item)
+        pos = pos_after
+
+def normalize_hts_code(raw) -> str:
+    """
+    6-digit subheading of a model-returned HTS code, plain ("847130") or printed ("8471.30.00"); "" if there is none.
+    """
+    text = str(raw or "")
+    m = _HTS_DIGITS_RE.match(_HTS_SEPARATOR_RE.sub("", text)) or _HTS_RE.search(text)
+    return m.group(0)[:6] if m else ""
+
+def inline_hts_codes(line_items: list[dict]) -> dict[tuple[str, str], str]:
+    """
+    (description, part number) -> the 6-digit code returned with the line item by the extraction call,
+    for items where it is a usable code.
+    """
+    codes = {}
+    for item in line_items:
+        code = normalize_hts_code(item.get("hts_6"))
+        if code:
+            codes.setdefault((item["description"], item["part_number"]), code)
+    return codes
+
+def parse_line_items(content: str | None) -> list[dict]:
+    """
+    Line items from an extraction answer. Output that was cut short (e.g. at the token limit) is repaired
+    rather than discarded; fields missing from a repaired item come back as "".
+    """
+    try:
+        return json.loads(content or "")["items"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        repaired = json_repair.loads(content or "")
+    items = repaired.get("items", []) if isinstance(repaired, dict) else []
+    return [
+        {field: str(item.get(field) or "") for field in LINE_ITEM_FIELDS}
+        for item in items if isinstance(item, dict)
+    ]
+
+# Persistent HTS predictions so repeated SKUs survive process restarts.
+HTS_CACHE_DIR = os.path.join("data", "hts_cache")
+
+@st.cache_resource
+def get_hts_disk_cache() -> diskcache.Cache:
+    return diskcache.Cache(HTS_CACHE_DIR)
+
+def _hts_cache_key(description: str, part_number: str) -> str:
+    return hashlib.sha1(f"{description}\x1f{part_number}".encode()).hexdigest()
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def ai_predict_hts_batch(items: list[tuple[str, str]], _on_known=None) -> list[str]:
+    """
+    Predict HTS codes for (description, part number) pairs. Pairs not in the disk cache are matched against
+    previously classified near-duplicates and the local HTS catalog first; only the ones without a confident match
+    are sent to the chat model.
+    _on_known, if given, is called with the codes already settled by the cache/catalog before that model call,
+    so callers can start downstream work while it is in flight. It is not called on a Streamlit cache hit.
+    """
+    codes, embeddings = lookup_hts_codes(items)
+    unmatched = [i for i, code in enumerate(codes) if not code]
+    if unmatched:
+        if _on_known is not None:
+            _on_known([code for code in codes if code])
+        predicted = _ai_predict_hts_uncached([items[i] for i in unmatched])
+        remember_hts_codes([items[i] for i in unmatched], predicted, [embeddings.get(i) for i in unmatched])
+        for i, code in zip(unmatched, predicted):
+            codes[i] = code
+    return codes
+
+def lookup_hts_codes(items: list[tuple[str, str]]) -> tuple[list[str], dict[int, np.ndarray]]:
+    """
+    HTS codes from the disk cache, near-duplicate cache and local catalog, "" for pairs none of them settle.
+    Also returns the embeddings computed for disk-cache misses by row, for remember_hts_codes.
+    """
+    disk_cache = get_hts_disk_cache()
+    codes = [disk_cache.get(_hts_cache_key(description, part_number), "") for description, part_number in items]
+    # One embedding call serves both the semantic cache and the catalog search.
+    texts = [f"{description} {part_number}".strip() for description, part_number in items]
+    embedded_rows = [i for i, code in enumerate(codes) if not code and texts[i]]
+    if not embedded_rows:
+        return codes, {}
+    # The similarity lookups only save chat calls, so if embedding fails the rows go to the chat model instead.
+    try:
+        embedded = embed_texts([texts[i] for i in embedded_rows])
+        matches = zip(match_semantic_cache(embedded), match_hts_catalog(embedded))
+    except Exception:
+        return codes, {}
+    for i, (cached, matched) in zip(embedded_rows, matches):
+        codes[i] = cached or matched
+    return codes, dict(zip(embedded_rows, embedded))
+
+def remember_hts_codes(items: list[tuple[str, str]], codes: list[str], embeddings: list) -> None:
+    """
+    Store model-predicted codes in the disk cache, and in the near-duplicate cache where the row's embedding is known.
+    """
+    disk_cache = get_hts_disk_cache()
+    for (description, part_number), code in zip(items, codes):
+        if code:
+            disk_cache.set(_hts_cache_key(description, part_number), code)
+    new = [k for k, code in enumerate(codes) if code and embeddings[k] is not None]
+    if new:
+        add_to_semantic_cache(np.stack([embeddings[k] for k in new]), [codes[k] for k in new])
+
+# Optional local HTS 6-digit catalog (CSV with `hts6` and `description` columns). Its embeddings are computed once
+# and stored next to it, so classifying a line item is a local nearest-neighbour search instead of a chat call.
+HTS_CATALOG_PATH = os.path.join("data", "hts6_catalog.csv")
+HTS_INDEX_PATH = os.path.join("data", "hts6_index.npz")
+EMBEDDING_BATCH_SIZE = 2048  # max inputs per embeddings request
+# Cosine similarity below which a catalog match is not trusted and the row falls back to the chat model.
+HTS_MATCH_MIN_SCORE = 0.6
+
+def embed_texts(texts: list[str]) -> np.ndarray:
+    """
+    Embed texts with as few API calls as possible. Rows are L2-normalized, so dot products are cosine similarities.
+    """
+    vectors = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        vectors.extend(_embed(texts[start:start + EMBEDDING_BATCH_SIZE]))
+    vecs = np.asarray(vectors, dtype=np.float32)
+    return vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+
+@st.cache_resource(show_spinner=False)
+def _load_hts_index(path: str, mtime: float) -> tuple[np.ndarray, list[str]]:
+    """
+    Return (float32 vectors, codes) for the HTS catalog at path, embedding it when the stored index is older.
+    """
+    # mtime is part of the cache key, so replacing the catalog rebuilds the index.
+    if os.path.exists(HTS_INDEX_PATH) and os.path.getmtime(HTS_INDEX_PATH) >= mtime:
+        with np.load(HTS_INDEX_PATH) as data:
+            if "vectors" in data.files:
+                return data["vectors"], data["codes"].tolist()
+    catalog = pd.read_csv(path, dtype=str).dropna(subset=["hts6", "description"])
+    codes = catalog["hts6"].str.strip().str.zfill(6).tolist()
+    hts_vecs = embed_texts(catalog["description"].tolist())
+    np.savez(HTS_INDEX_PATH, vectors=hts_vecs, codes=np.asarray(codes))
+    return hts_vecs, codes
+
+def load_hts_index() -> tuple[np.ndarray, list[str]] | None:
+    """
+    (float32 vectors, codes) for the local HTS catalog; None when there is no catalog.
+    """
+    if not os.path.exists(HTS_CATALOG_PATH):
+        return None
+    return _load_hts_index(HTS_CATALOG_PATH, os.path.getmtime(HTS_CATALOG_PATH))
+
+def match_hts_catalog(embedded: np.ndarray) -> list[str]:
+    """
+    Nearest-neighbour HTS code for each embedded line item, or "" when there is no catalog
+    or the best match scores below HTS_MATCH_MIN_SCORE.
+    """
+    index = load_hts_index()
+    if index is None:
+        return [""] * len(embedded)
+    hts_vecs, hts_codes = index
+    scores = embedded @ hts_vecs.T
+    best = np.argmax(scores, axis=1)
+    best_scores = scores[np.arange(len(embedded)), best]
+    return [hts_codes[b] if score >= HTS_MATCH_MIN_SCORE else "" for b, score in zip(best, best_scores)]
+
+# Embeddings of line items the chat model has classified, with their codes, so near-duplicate descriptions
+# ("HEX BOLT M6x20 ZN" vs "M6 hex bolt 20mm zinc") reuse the earlier answer instead of another chat call.
+# Each append writes one shard file (embeddings + codes), so a save costs the size of the batch, not the store;
+# once the store is over HTS_SEMANTIC_CACHE_MAX_ENTRIES the oldest shards are deleted.
+HTS_SEMANTIC_CACHE_DIR = os.path.join("data", "hts_semantic_cache")
+HTS_SEMANTIC_MIN_SCORE = 0.95
+HTS_SEMANTIC_CACHE_MAX_ENTRIES = 20_000
+
+@st.cache_resource(show_spinner=False)
+def get_hts_semantic_cache() -> dict:
+    embeddings, codes, shards = [], [], []  # shards: (path, row count), oldest first
+    if os.path.isdir(HTS_SEMANTIC_CACHE_DIR):
+        for name in sorted(os.listdir(HTS_SEMANTIC_CACHE_DIR)):
+            if not name.endswith(".npz"):
+                continue
+            path = os.path.join(HTS_SEMANTIC_CACHE_DIR, name)
+            with np.load(path) as data:
+                embeddings.append(data["embeddings"])
+                codes.extend(data["codes"].tolist())
+            shards.append((path, len(embeddings[-1])))
+    return {
+        "embeddings": np.concatenate(embeddings) if embeddings else None,
+        "codes": codes,
+        "shards": shards,
+        "lock": threading.Lock(),
+    }
+
+def match_semantic_cache(embedded: np.ndarray) -> list[str]:
+    """
+    Cached HTS code of the most similar previously classified item, or "" below HTS_SEMANTIC_MIN_SCORE.
+    """
+    cache = get_hts_semantic_cache()
+    with cache["lock"]:
+        cached, cached_codes = cache["embeddings"], cache["codes"]
+    if not cached_codes:
+        return [""] * len(embedded)
+    scores = embedded @ cached.T
+    best = np.argmax(scores, axis=1)
+    best_scores = scores[np.arange(len(embedded)), best]
+    return [cached_codes[b] if score >= HTS_SEMANTIC_MIN_SCORE else "" for b, score in zip(best, best_scores)]
+
+def add_to_semantic_cache(embedded: np.ndarray, codes: list[str]) -> None:
+    cache = get_hts_semantic_cache()
+    with cache["lock"]:
+        os.makedirs(HTS_SEMANTIC_CACHE_DIR, exist_ok=True)
+        # Timestamp prefix keeps shards in append order, so the oldest are evicted first.
+        path = os.path.join(HTS_SEMANTIC_CACHE_DIR, f"shard-{datetime.now():%Y%m%d%H%M%S%f}-{uuid.uuid4().hex[:8]}.npz")
+        np.savez(path, embeddings=embedded, codes=np.asarray(codes))
+        cache["shards"].append((path, len(codes)))
+        all_embeddings = embedded if cache["embeddings"] is None else np.vstack([cache["embeddings"], embedded])
+        all_codes = cache["codes"] + codes
+        dropped = 0
+        while len(all_codes) - dropped > HTS_SEMANTIC_CACHE_MAX_ENTRIES and len(cache["shards"]) > 1:
+            old_path, rows = cache["shards"].pop(0)
+            os.remove(old_path)
+            dropped += rows
+        cache["embeddings"], cache["codes"] = all_embeddings[dropped:], all_codes[dropped:]
+
+HTS_BATCH_SCHEMA = {
+    "name": "hts_codes",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "codes": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"id": {"type": "integer"}, "hts": {"type": "string"}},
+                    "required": ["id", "hts"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["codes"],
+        "additionalProperties": False,
+    },
+}
+
+# Output budget per classified item; an entry like {"id":12,"hts":"847130"}, is about a dozen tokens.
+HTS_TOKENS_PER_ITEM = 20
+# gpt-4o-mini's output token limit.
+HTS_MAX_OUTPUT_TOKENS = 16_384
+# Pairs classified per request (realtime or Batch API), so each answer stays well inside the output token limit.
+HTS_REQUEST_ROWS = 50
+# Upper bound on concurrent realtime HTS requests for one invoice.
+HTS_MAX_WORKERS = 4
+
+def hts_request(items: list[tuple[str, str]]) -> dict:
+    """
+    Chat completion parameters for classifying (description, part number) pairs (shared by the realtime and
+    Batch API paths). Answers carry the item's position in `items` as their id.
+    """
+    # JSON-encode the items so descriptions containing newlines or quotes can't blur row boundaries;
+    # compact separators keep the per-item overhead to a few tokens.
+    rows = json.dumps(
+        [{"id": i, "desc": description, "part": part_number} for i, (description, part_number) in enumerate(items)],
+        separators=(",", ":"),
+    )
     prompt = (
-        "Given the following item description and part number, predict the most likely 6-digit HTS "
-        "(Harmonized Tariff Schedule) code for US import, based on standard customs practices. "
-        "Respond with ONLY the 6-digit code (no words).\n\n"
-        f"Description: {description}\n"
-        f"Part Number: {part_number}"
+        "Give the most likely 6-digit US HTS code for each item from its description and part number. "
+        'One "codes" entry per item: "id" copied from the item, "hts" the 6 digits.\n'
+        f"Items:{rows}"
     )
-    resp = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
             {"role": "system", "content": "You are a customs tariff specialist."},
             {"role": "user", "content": prompt},
         ],
-        temperature=0
-    )
-    raw = (resp.choices[0].message.content or "").strip()
-    m = re.search(r"\b\d{6,10}\b", raw)
-    return m.group(0)[:6] if m else (raw[:6] if raw and raw[:6].isdigit() else "")
+        "response_format": {"type": "json_schema", "json_schema": HTS_BATCH_SCHEMA},
+        "temperature": 0,
+        # Each answer is one short {"id","hts"} entry, so bound the output to the batch size.
+        "max_tokens": min(HTS_MAX_OUTPUT_TOKENS, 32 + HTS_TOKENS_PER_ITEM * len(items)),
+    }
+
+def parse_hts_codes(content: str | None, count: int) -> list[str]:
+    """
+    One 6-digit code per requested item, in request order, from an hts_request answer; skipped items come back as "".
+    """
+    try:
+        entries = json.loads(content or "{}").get("codes", [])
+    except (json.JSONDecodeError, AttributeError):
+        # An answer cut off at max_tokens still carries every entry before the cut.
+        repaired = json_repair.loads(content or "")
+        entries = repaired.get("codes", []) if isinstance(repaired, dict) else []
+
+    # The model may reorder or skip entries, so map answers back by id rather than position.
+    codes_by_id = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            item_id = int(entry.get("id"))
+        except (TypeError, ValueError):
+            continue
+        codes_by_id[item_id] = normalize_hts_code(entry.get("hts"))
+    return [codes_by_id.get(i, "") for i in range(count)]
+
+def _ai_predict_hts_uncached(items: list[tuple[str, str]]) -> list[str]:
+    """
+    Ask the model for the likely 6-digit HTS code of every (description, part number) pair, HTS_REQUEST_ROWS pairs
+    per concurrent call. Returns one code per input row, in input order; rows the model skipped come back as "".
+    """
+    if not items:
+        return []
+    groups = [items[start:start + HTS_REQUEST_ROWS] for start in range(0, len(items), HTS_REQUEST_ROWS)]
+    with ThreadPoolExecutor(max_workers=min(len(groups), HTS_MAX_WORKERS)) as executor:
+        return [code for codes in executor.map(_predict_hts_group, groups) for code in codes]
+
+def _predict_hts_group(items: list[tuple[str, str]]) -> list[str]:
+    # Ids in each request start at 0, so a group's answers map back to its own slice of the input.
+    resp = _chat(**hts_request(items))
+    return parse_hts_codes(resp.choices[0].message.content, len(items))
+
+# Optional local copy of the Bahamas tariff schedule: Parquet with an `hts6` column followed by duty/tax columns.
+# When present, lookups are a dict hit instead of a scrape of the customs search page.
+TARIFF_TABLE_PATH = os.path.join("data", "bahamas_tariff.parquet")
+TARIFF_TABLE_MAX_AGE_DAYS = 7
+
+@st.cache_resource(show_spinner=False)
+def _load_tariff_table(path: str, mtime: float) -> dict[str, str]:
+    # mtime is part of the cache key, so replacing the file picks up the new schedule.
+    df = pd.read_parquet(path).fillna("").astype(str)
+    df["hts6"] = df["hts6"].str.strip().str.zfill(6)
+    df = df[["hts6", *(c for c in df.columns if c != "hts6")]].drop_duplicates("hts6")
+    return {row[0]: " | ".join(row) for row in df.itertuples(index=False, name=None)}
+
+def tariff_table() -> dict[str, str] | None:
+    """
+    Local tariff rows keyed by 6-digit code, formatted like scraped rows; None when there is no local schedule.
+    """
+    if not os.path.exists(TARIFF_TABLE_PATH):
+        return None
+    return _load_tariff_table(TARIFF_TABLE_PATH, os.path.getmtime(TARIFF_TABLE_PATH))
+
+# Scraped tariff rows by 6-digit code, kept across restarts; the schedule changes rarely and codes repeat
+# across invoices.
+TARIFF_CACHE_DIR = os.path.join("data", "tariff_cache")
+TARIFF_CACHE_TTL_DAYS = 7
+
+@st.cache_resource(show_spinner=False)
+def get_tariff_disk_cache() -> diskcache.Cache:
+    return diskcache.Cache(TARIFF_CACHE_DIR)
+
+class TariffRowNotFound(Exception):
+    """The tariff search page came back without a row for the code."""
 
 def get_bahamas_tariff(hts_code: str) -> str:
     """
-    Scrape Bahamas Customs search page for the code row.
+    Look up the code in the local tariff table, or scrape Bahamas Customs search page for the code row.
+    Scraped rows are cached on disk for TARIFF_CACHE_TTL_DAYS; failed lookups and missing rows are not cached.
     """
     if not hts_code:
         return "No HTS code predicted"
-    url = f'https://www.bahamascustoms.gov.bs/tariffs-and-various-taxes-collected-by-customs/tariff-search/?q={hts_code}'
+    table = tariff_table()
+    if table is not None:
+        return table.get(hts_code[:6], "No match in local tariff table")
+    hts6 = hts_code[:6]
+    disk_cache = get_tariff_disk_cache()
+    cached = disk_cache.get(hts6)
+    if cached is not None:
+        return cached
     try:
-        resp = requests.get(url, timeout=10)
-        resp.raise_for_status()
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        table = soup.find('table')
-        if not table:
-            return "No result table found"
-        rows = table.find_all('tr')
-        for r in rows[1:]:
-            cols = [c.get_text(strip=True) for c in r.find_all(['td', 'th'])]
-            if cols and hts_code[:6] in (cols[0] or ""):
-                return " | ".join(cols)
-        return "Result table found, but HTS code row missing"
+        result = _fetch_bahamas_tariff(hts6)
+    except TariffRowNotFound as e:
+        return str(e)
     except Exception as e:
         return f"Error: {str(e)}"
+    disk_cache.set(hts6, result, expire=TARIFF_CACHE_TTL_DAYS * 86400)
+    return result
+
+@st.cache_resource(show_spinner=False)
+def get_tariff_client() -> httpx.Client:
+    # One pooled keep-alive (HTTP/2) client shared by every tariff lookup thread, so TLS handshakes are paid once.
+    # The transport retries failed connection attempts; httpx already asks for gzip-compressed responses.
+    return httpx.Client(
+        timeout=10,
+        transport=httpx.HTTPTransport(http2=True, retries=3, limits=httpx.Limits(max_keepalive_connections=20)),
+    )
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def _fetch_bahamas_tariff(hts_code: str) -> str:
+    # Network/HTTP errors and pages without the code's row propagate, so only rows actually found are cached.
+    url = f'https://www.bahamascustoms.gov.bs/tariffs-and-various-taxes-collected-by-customs/tariff-search/?q={hts_code}'
+    resp = get_tariff_client().get(url)
+    resp.raise_for_status()
+    # Lexbor reads bytes as UTF-8, so pages in any other declared charset are decoded by httpx first.
+    charset = (resp.charset_encoding or "utf-8").lower().replace("_", "-")
+    tree = LexborHTMLParser(resp.content if charset in ("utf-8", "utf8") else resp.text)
+    table = tree.css_first('table')
+    if not table:
+        raise TariffRowNotFound("No result table found")
+    # Only the code cell is read until the matching row is found; codes may be printed dotted ("8471.30.00").
+    prefix = hts_code[:6]
+    for r in table.css('tr')[1:]:
+        first = r.css_first('td, th')
+        if first is None or not first.text(strip=True).replace(".", "").replace(" ", "").startswith(prefix):
+            continue
+        return " | ".join(c.text(strip=True) for c in r.css('td, th'))
+    raise TariffRowNotFound("Result table found, but HTS code row missing")
+
+# Upper bound on concurrent Bahamas Customs requests, shared by every session's prefetch and enrichment lookups.
+ENRICH_MAX_WORKERS = 16
+
+@st.cache_resource(show_spinner=False)
+def get_tariff_executor() -> ThreadPoolExecutor:
+    # Tasks run in submission order, so an enrichment lookup waiting on a prefetch of the same code never
+    # blocks that prefetch from starting.
+    return ThreadPoolExecutor(max_workers=ENRICH_MAX_WORKERS, thread_name_prefix="tariff")
+
+def prefetch_tariffs(line_items: list[dict], started: set) -> None:
+    """
+    Start tariff lookups for the items' inline HTS codes not in `started` (updated in place). The lookups fill the
+    tariff caches, so summarize_line_items later finds them done, or waits on the one in flight.
+    """
+    for code in set(inline_hts_codes(line_items).values()) - started:
+        started.add(code)
+        get_tariff_executor().submit(get_bahamas_tariff, code)
+
+SUMMARY_COLUMNS = (
+    "Invoice", "Invoice Date", "Line", "Description", "Part Number", "Brand",
+    "Qty", "Price", "Ext. Price", "HTS Code", "Bahamas Tariff Result",
+)
+# Extracted line item field -> findings table column.
+LINE_ITEM_COLUMNS = {
+    "invoice_number": "Invoice",
+    "invoice_date": "Invoice Date",
+    "description": "Description",
+    "part_number": "Part Number",
+    "brand": "Brand",
+    "quantity": "Qty",
+    "price": "Price",
+    "extended_price": "Ext. Price",
+}
+NUMERIC_COLUMNS = ("Qty", "Price", "Ext. Price")
+# Currency symbols/codes and whitespace around model-extracted amounts.
+_CURRENCY_RE = re.compile(r"B?\$|[€£¥\s]|(?i:usd|bsd)")
+# A plain amount, optionally with well-formed thousands separators ("1,234.50"). Anything else (decimal commas,
+# accounting parentheses, "12 x 2.50") is ambiguous and must not be guessed at.
+_AMOUNT_RE = re.compile(r"-?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?|-?\.\d+")
 
-EXCEL_LOG_PATH = os.path.join("data", "invoice_tariff_log.xlsx")
+def to_number(values: pd.Series) -> pd.Series:
+    """
+    Coerce model-extracted amounts like "$1,234.50" to floats; anything that is not a well-formed amount becomes NaN.
+    """
+    text = values.astype(str).str.replace(_CURRENCY_RE, "", regex=True)
+    text = text.where(text.str.fullmatch(_AMOUNT_RE), None)
+    return pd.to_numeric(text.str.replace(",", "", regex=False), errors="coerce")
+
+# Append-only Parquet dataset: each save writes one new part file.
+TARIFF_LOG_DIR = os.path.join("data", "invoice_tariff_log")
 if "save_confirmed" not in st.session_state:
     st.session_state.save_confirmed = False
     st.session_state.last_saved = None
     st.session_state.latest_log = None
+if "pending_batches" not in st.session_state:
+    st.session_state.pending_batches = []
+if "hts_batch_uploads" not in st.session_state:
+    # Realtime upload file_id -> its HTS job, once queue_hts_batch has handled that upload.
+    st.session_state.hts_batch_uploads = {}
+
+# The log before it moved to Parquet. It is imported once, as a part file that sorts ahead of every save,
+# so the aggregated view keeps its history; the xlsx itself is left in place.
+LEGACY_EXCEL_LOG_PATH = os.path.join("data", "invoice_tariff_log.xlsx")
+LEGACY_LOG_PART = "part-00000000000000000000-legacy-{i}.parquet"
 
 def append_to_excel_log(df: pd.DataFrame, path: str) -> pd.DataFrame:
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    if os.path.exists(path):
-        existing = pd.read_excel(path)
-        combined = pd.concat([existing, df], ignore_index=True)
-    else:
-        combined = df
-    combined.to_excel(path, index=False)
-    return combined
+    import_legacy_excel_log(path)
+    # Timestamp prefix keeps part files (and so the aggregated log) in save order.
+    _write_log_part(df, path, f"part-{datetime.now():%Y%m%d%H%M%S%f}-{uuid.uuid4().hex[:8]}-{{i}}.parquet")
+    return read_tariff_log(path)
+
+def import_legacy_excel_log(path: str) -> None:
+    if not os.path.exists(LEGACY_EXCEL_LOG_PATH) or os.path.exists(os.path.join(path, LEGACY_LOG_PART.format(i=0))):
+        return
+    legacy = pd.read_excel(LEGACY_EXCEL_LOG_PATH, dtype=str).reindex(columns=list(SUMMARY_COLUMNS))
+    # Match the column types of the parts written by append_to_excel_log.
+    legacy["Line"] = pd.to_numeric(legacy["Line"], errors="coerce").astype("Int64")
+    for col in NUMERIC_COLUMNS:
+        legacy[col] = to_number(legacy[col])
+    _write_log_part(legacy, path, LEGACY_LOG_PART)
+
+def _write_log_part(df: pd.DataFrame, path: str, basename_template: str) -> None:
+    os.makedirs(path, exist_ok=True)
+    # Model output can mix numbers and strings in one column; store free-form columns as text.
+    text_cols = {c: "string" for c in df.columns if df[c].dtype == object}
+    table = pa.Table.from_pandas(df.astype(text_cols), preserve_index=False)
+    ds.write_dataset(
+        table,
+        path,
+        format="parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        basename_template=basename_template,
+    )
+
+def read_tariff_log(path: str) -> pd.DataFrame:
+    return ds.dataset(path, format="parquet").to_table().to_pandas()
+
+@st.cache_data(show_spinner=False)
+def df_to_csv_bytes(df: pd.DataFrame) -> bytes:
+    # Arrow's C++ CSV writer; cached on the frame's content so reruns reuse the bytes.
+    buf = io.BytesIO()
+    pcsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buf)
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False)
+def log_to_excel_bytes(df: pd.DataFrame) -> bytes:
+    # openpyxl is slow on a long log, so only rebuild the export when the log has changed.
+    buf = io.BytesIO()
+    df.to_excel(buf, index=False)
+    return buf.getvalue()
+
+# -------------- OpenAI Batch API --------------
+# Batch-mode invoices with more lines than this get their HTS codes from the Batch API even without the checkbox.
+HTS_BATCH_API_MIN_LINES = 50
+
+def submit_batch(bodies: dict[str, dict], file_name: str) -> str:
+    """
+    Queue chat completion requests on the OpenAI Batch API (half price, 24h window), keyed by custom_id.
+    Returns the batch id.
+    """
+    lines = [
+        json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body})
+        for custom_id, body in bodies.items()
+    ]
+    batch_file = _openai_retry(client.files.create)(file=(file_name, "\n".join(lines).encode()), purpose="batch")
+    batch = _openai_retry(client.batches.create)(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+def submit_extraction_batch(pdf_texts: dict[str, str]) -> str:
+    """
+    Queue one extraction request per invoice text. Keys of pdf_texts become the request custom_ids.
+    """
+    return submit_batch(
+        {custom_id: extraction_request(pdf_text) for custom_id, pdf_text in pdf_texts.items()},
+        "invoice_extraction.jsonl",
+    )
+
+def submit_hts_batch(items: list[tuple[str, str]]) -> str:
+    """
+    Queue HTS classification of (description, part number) pairs, HTS_REQUEST_ROWS per request.
+    Each request's custom_id is "hts-<index of its first item>".
+    """
+    return submit_batch(
+        {f"hts-{start}": hts_request(items[start:start + HTS_REQUEST_ROWS])
+         for start in range(0, len(items), HTS_REQUEST_ROWS)},
+        "hts_classification.jsonl",
+    )
+
+def read_batch_file(file_id: str) -> dict:
+    """
+    Map each custom_id in a batch output/error file to its response message, or to an error message string.
+    """
+    results = {}
+    for line in _openai_retry(client.files.content)(file_id).text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            results[record["custom_id"]] = f"Request failed: {record.get('error') or response.get('body')}"
+            continue
+        results[record["custom_id"]] = response["body"]["choices"][0]["message"]
+    return results
+
+def extraction_batch_result(message) -> list[dict] | str:
+    """
+    Line items from a read_batch_file extraction result, or an error message.
+    """
+    if isinstance(message, str):
+        return message
+    if message.get("refusal"):
+        return f"Model refused the extraction: {message['refusal']}"
+    items = parse_line_items(message.get("content"))
+    return items if items else "Unreadable or empty extraction output"
+
+# -------------- Enrichment & Findings --------------
+def summarize_line_items(line_items: list[dict], hts_by_pair: dict | None = None) -> pd.DataFrame:
+    """
+    Predict HTS codes (unless given by (description, part number)), look up Bahamas tariffs and build the
+    findings table.
+    """
+    if os.path.exists(TARIFF_TABLE_PATH):
+        age_days = (datetime.now().timestamp() - os.path.getmtime(TARIFF_TABLE_PATH)) / 86400
+        if age_days > TARIFF_TABLE_MAX_AGE_DAYS:
+            st.warning(f"The local tariff table is {age_days:.0f} days old. Refresh {TARIFF_TABLE_PATH}.")
+
+    # One batched call classifies every distinct (description, part number) pair; repeated lines share the answer.
+    # Tariff lookups are network-bound, so they run concurrently, once per distinct code, and codes already known
+    # from the HTS cache/catalog start before the model call returns.
+    pairs = [(item["description"], item["part_number"]) for item in line_items]
+    unique_pairs = list(dict.fromkeys(pairs))
+    with st.spinner("Predicting HTS codes and checking Bahamas tariffs..."):
+        executor = get_tariff_executor()
+        tariff_futures = {}
+
+        def start_tariff_lookups(codes: list[str]) -> None:
+            for code in codes:
+                if code not in tariff_futures:
+                    tariff_futures[code] = executor.submit(get_bahamas_tariff, code)
+
+        if hts_by_pair is None:
+            # Codes returned by the extraction call are used as is; only the rest need classifying.
+            hts_by_pair = inline_hts_codes(line_items)
+            start_tariff_lookups(list(hts_by_pair.values()))
+            missing = [pair for pair in unique_pairs if pair not in hts_by_pair]
+            if missing:
+                predicted = ai_predict_hts_batch(missing, _on_known=start_tariff_lookups)
+                hts_by_pair.update(zip(missing, predicted))
+        hts_codes = [hts_by_pair[pair] for pair in pairs]
+        start_tariff_lookups(hts_codes)
+        tariff_by_code = {code: future.result() for code, future in tariff_futures.items()}
+
+    df = pd.DataFrame(line_items, columns=list(LINE_ITEM_FIELDS)).rename(columns=LINE_ITEM_COLUMNS)
+    df["Line"] = df.groupby(["Invoice", "Invoice Date"], sort=False).cumcount() + 1
+    df["HTS Code"] = hts_codes
+    df["Bahamas Tariff Result"] = df["HTS Code"].map(tariff_by_code)
+    for col in NUMERIC_COLUMNS:
+        df[col] = to_number(df[col])
+    return df[list(SUMMARY_COLUMNS)]
+
+def render_findings(df: pd.DataFrame, key: str = "realtime") -> None:
+    with st.container():
+        st.markdown("<div class='invoice-card'>", unsafe_allow_html=True)
+        st.subheader("3. Review & Export Findings")
+        st.dataframe(df, use_container_width=True, hide_index=True)
+
+        col_download, col_save = st.columns([1, 1])
+        with col_download:
+            st.download_button(
+                "Download as CSV",
+                df_to_csv_bytes(df),
+                "invoice_tariff_summary.csv",
+                type="primary",
+                key=f"download-{key}",
+            )
+        with col_save:
+            if st.button("Append to internal tariff log", type="secondary", key=f"append-{key}"):
+                combined = append_to_excel_log(df, TARIFF_LOG_DIR)
+                st.session_state.save_confirmed = True
+                st.session_state.last_saved = datetime.now()
+                st.session_state.latest_log = combined
+
+        if st.session_state.get("save_confirmed"):
+            ts = st.session_state.last_saved.strftime("%d %b %Y • %H:%M") if st.session_state.last_saved else ""
+            st.markdown(
+                f"""
+                <div class='save-banner'>
+                    ✅ Results appended to the shared tariff log.<br/>
+                    <span style='font-size:0.9rem;'>Saved {ts}. Dataset location: <code>{TARIFF_LOG_DIR}</code></span>
+                </div>
+                """,
+                unsafe_allow_html=True,
+            )
+            with st.expander("View aggregated tariff log", expanded=False):
+                log_df = st.session_state.get("latest_log")
+                if log_df is not None:
+                    st.dataframe(log_df, use_container_width=True, hide_index=True)
+                    st.download_button(
+                        "Export log as Excel",
+                        log_to_excel_bytes(log_df),
+                        "invoice_tariff_log.xlsx",
+                        key=f"export-log-{key}",
+                    )
+        st.markdown("</div>", unsafe_allow_html=True)
+
+def render_research_links() -> None:
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("### Manual HS Lookups")
+        st.write("Use the Bahamas Customs tariff search for confirmation and duty rate checks.")
+        st.link_button(
+            "Open Bahamas Tariff Search",
+            "https://www.bahamascustoms.gov.bs/tariffs-and-various-taxes-collected-by-customs/tariff-search/",
+            type="primary",
+        )
+    with col2:
+        st.markdown("### Research Tips")
+        st.markdown(
+            "- Validate descriptions using manufacturer websites.\n"
+            "- Cross-check HS codes with recent rulings.\n"
+            "- Capture duty rate notes in the tariff log after review."
+        )
+
+def queue_hts_batch(job: dict) -> None:
+    """
+    Settle the HTS codes of the job's distinct (description, part number) pairs from the extraction answers and
+    the caches/catalog, and queue the rest as an HTS batch, which becomes the job's current batch.
+    Leaves job["hts_rows"] empty when nothing had to be queued, and the job untouched on failure.
+    """
+    inline = inline_hts_codes(job["line_items"])
+    pairs = [
+        pair for pair in dict.fromkeys((item["description"], item["part_number"]) for item in job["line_items"])
+        if pair not in inline
+    ]
+    codes, embeddings = lookup_hts_codes(pairs)
+    rows = [i for i, code in enumerate(codes) if not code]
+    if rows:
+        job["id"] = submit_hts_batch([pairs[i] for i in rows])
+        job["submitted"] = datetime.now()
+        job["hts_embeddings"] = [embeddings.get(i) for i in rows]
+    job["hts_pairs"], job["hts_codes"] = [*inline, *pairs], [*inline.values(), *codes]
+    job["hts_rows"] = [len(inline) + i for i in rows]
+
+def apply_hts_batch(job: dict, messages: dict) -> None:
+    rows = job["hts_rows"]
+    predicted = []
+    for start in range(0, len(rows), HTS_REQUEST_ROWS):
+        message = messages.get(f"hts-{start}")
+        content = message.get("content") if isinstance(message, dict) else None
+        predicted.extend(parse_hts_codes(content, len(rows[start:start + HTS_REQUEST_ROWS])))
+    pairs = [job["hts_pairs"][i] for i in rows]
+    remember_hts_codes(pairs, predicted, job["hts_embeddings"])
+    for i, code in zip(rows, predicted):
+        job["hts_codes"][i] = code
+    job["hts_rows"] = []
+
+# Batch statuses after which no more results will arrive.
+BATCH_END_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def _completed_batch_messages(job: dict) -> dict | None:
+    """
+    Results of the job's current batch by custom_id once it has ended, or None (after showing its status) while it
+    is still running. A batch that failed, expired or was cancelled yields whatever results it has, and the failure
+    is added to the job's warnings.
+    """
+    try:
+        batch = _openai_retry(client.batches.retrieve)(job["id"])
+    except Exception as e:
+        st.error(f"Could not check batch {job['id']}: {e}")
+        return None
+    if batch.status not in BATCH_END_STATUSES:
+        counts = batch.request_counts
+        done = f" ({counts.completed}/{counts.total} requests done)" if counts else ""
+        st.info(f"Batch {job['id']} submitted {job['submitted']:%d %b %Y • %H:%M}: {batch.status}{done}")
+        return None
+    if batch.status != "completed":
+        errors = "; ".join(e.message or e.code or "" for e in (getattr(batch.errors, "data", None) or []))
+        job["warnings"].append(
+            f"Batch {job['id']} {batch.status}{f': {errors}' if errors else ''}. "
+            "Results it did produce are shown; the rest are reported as missing."
+        )
+    messages = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            messages.update(read_batch_file(file_id))
+    return messages
+
+def render_batch_jobs() -> None:
+    """
+    Show queued batches; once a job's extraction (and, if queued, HTS classification) has ended,
+    enrich and display its invoices like a realtime upload. Any job can be dismissed from the list.
+    """
+    any_results = False
+    for job in list(st.session_state.pending_batches):
+        # The job's id moves on to its HTS batch, so the widget key stays on the id it was queued under.
+        if st.button(f"Dismiss batch {job['id']}", key=f"dismiss-{job.setdefault('key', job['id'])}"):
+            st.session_state.pending_batches.remove(job)
+            continue
+        if job["line_items"] is None:
+            messages = _completed_batch_messages(job)
+            if messages is None:
+                continue
+            job["line_items"] = []
+            for custom_id, file_name in job["files"].items():
+                result = extraction_batch_result(messages.get(custom_id, "No result returned"))
+                if isinstance(result, str):
+                    job["warnings"].append(f"{file_name}: {result}")
+                else:
+                    job["line_items"].extend(result)
+            if job["line_items"] and (job["hts_via_batch"] or len(job["line_items"]) > HTS_BATCH_API_MIN_LINES):
+                try:
+                    queue_hts_batch(job)
+                except Exception as e:
+                    st.error(f"Submitting the HTS batch job failed: {e}")
+
+        hts_running = False
+        if job.get("hts_rows"):
+            messages = _completed_batch_messages(job)
+            if messages is None:
+                hts_running = True
+            else:
+                apply_hts_batch(job, messages)
+        for warning in job["warnings"]:
+            st.warning(warning)
+        if job["line_items"] and not hts_running:
+            any_results = True
+            st.caption(f"Batch {job['id']}: " + ", ".join(job["files"].values()))
+            hts_by_pair = dict(zip(job["hts_pairs"], job["hts_codes"])) if "hts_codes" in job else None
+            render_findings(summarize_line_items(job["line_items"], hts_by_pair), key=job["id"])
+    if any_results:
+        render_research_links()
 
 # -------------- UI: Upload --------------
 with st.container():
@@ -217,13 +1250,47 @@ with st.container():
         """,
         unsafe_allow_html=True,
     )
-    uploaded_file = st.file_uploader("Select invoice PDF", type="pdf", label_visibility="collapsed")
+    batch_mode = st.toggle(
+        "Batch mode: queue several invoices as an OpenAI batch job (about half the cost, results within 24 hours)"
+    )
+    if batch_mode:
+        uploaded_files = st.file_uploader(
+            "Select invoice PDFs", type="pdf", accept_multiple_files=True, label_visibility="collapsed"
+        )
+        uploaded_file = None
+    else:
+        uploaded_file = st.file_uploader("Select invoice PDF", type="pdf", label_visibility="collapsed")
+    hts_via_batch = st.checkbox(
+        "Classify HTS codes with the Batch API too (about half the cost, results within 24 hours). "
+        f"Always on in batch mode for invoices over {HTS_BATCH_API_MIN_LINES} lines."
+    )
     st.markdown("</div>", unsafe_allow_html=True)
 
 # -------------- Processing --------------
-if uploaded_file:
+if batch_mode:
+    if uploaded_files and st.button("Submit batch job", type="primary"):
+        with st.spinner("Extracting text (using OCR if needed)..."):
+            pdf_texts = {
+                f"{n}-extract": extract_text_with_ocr(f.getvalue()) for n, f in enumerate(uploaded_files, start=1)
+            }
+        try:
+            batch_id = submit_extraction_batch(pdf_texts)
+        except Exception as e:
+            st.error(f"Submitting the batch job failed: {e}")
+        else:
+            st.session_state.pending_batches.append({
+                "id": batch_id,
+                "files": {custom_id: f.name for custom_id, f in zip(pdf_texts, uploaded_files)},
+                "submitted": datetime.now(),
+                "line_items": None,
+                "warnings": [],
+                "hts_via_batch": hts_via_batch,
+            })
+            st.success(f"Queued {len(pdf_texts)} invoice(s) as batch {batch_id}.")
+
+elif uploaded_file:
     with st.spinner("Extracting text (using OCR if needed)..."):
-        pdf_text = extract_text_with_ocr(uploaded_file)
+        pdf_text = extract_text_with_ocr(uploaded_file.getvalue())
 
     with st.expander("Preview extracted text", expanded=False):
         preview = (pdf_text or "")
@@ -234,7 +1301,7 @@ if uploaded_file:
         <div class='invoice-card'>
         <h3 style='color: var(--muted-text); letter-spacing:0.08em; text-transform: uppercase;'>2. Line Item Intelligence</h3>
         <p style='color: var(--text-dark); font-size:0.95rem;'>
-        Line items are parsed and enriched via GPT-4o. Each entry is cross-referenced with the Bahamas Customs tariff search
+        Line items are parsed and enriched via GPT-4o mini. Each entry is cross-referenced with the Bahamas Customs tariff search
         using the suggested HS code.
         </p>
         </div>
@@ -242,123 +1309,43 @@ if uploaded_file:
         unsafe_allow_html=True,
     )
 
-    st.info("Extracting line items and invoice fields using AI (GPT-4o)...")
-    invoice_data_json = ai_extract_invoice_data(pdf_text)
-
-    # Try to parse a JSON array anywhere in the response
+    st.info("Extracting line items and invoice fields using AI (GPT-4o mini)...")
     line_items = []
-    try:
-        start = invoice_data_json.find("[")
-        end = invoice_data_json.rfind("]")
-        if start != -1 and end != -1 and end > start:
-            line_items = json.loads(invoice_data_json[start : end + 1])
-        else:
-            # If model returned object with a key, try to extract 'items' or similar
-            obj = json.loads(invoice_data_json)
-            if isinstance(obj, dict):
-                # pick first array value
-                for v in obj.values():
-                    if isinstance(v, list):
-                        line_items = v
-                        break
-    except Exception:
-        st.error("AI extraction did not return clean JSON. Displaying raw model output below for troubleshooting.")
-        st.code(invoice_data_json)
+    # Load (or first build) the HTS catalog index in the background while the extraction streams in.
+    with ThreadPoolExecutor(max_workers=1) as warmup:
+        warmup.submit(load_hts_index)
+        try:
+            line_items = ai_extract_invoice_data(pdf_text)
+        except Exception as e:
+            st.error(f"AI extraction failed: {e}")
 
-    summary_rows = []
-    invoice_number_tracker = {}
-    for item in line_items:
-        # Normalize keys; model outputs can vary slightly
-        desc = item.get("description", item.get("Description", ""))
-        part = item.get("item/manufacturer part number", item.get("part_number", item.get("Part Number", "")))
-        brand = item.get("brand", item.get("Brand", ""))
-        qty = item.get("quantity", item.get("Quantity", ""))
-        price = item.get("price", item.get("Price", ""))
-        ext_price = item.get("extended price", item.get("extended_price", item.get("Ext. Price", "")))
-        invoice_number = item.get("invoice number", item.get("invoice", item.get("Invoice", "")))
-        invoice_date = item.get("invoice date", item.get("Invoice Date", ""))
-
-        key = (invoice_number, invoice_date)
-        invoice_number_tracker.setdefault(key, 0)
-        invoice_number_tracker[key] += 1
-        line_index = invoice_number_tracker[key]
-
-        hts_code = ai_predict_hts(desc or "", part or "")
-        bahamas_tariff = get_bahamas_tariff(hts_code)
-
-        summary_rows.append({
-            "Invoice": invoice_number,
-            "Invoice Date": invoice_date,
-            "Line": line_index,
-            "Description": desc,
-            "Part Number": part,
-            "Brand": brand,
-            "Qty": qty,
-            "Price": price,
-            "Ext. Price": ext_price,
-            "HTS Code": hts_code,
-            "Bahamas Tariff Result": bahamas_tariff
-        })
-
-    if summary_rows:
-        df = pd.DataFrame(summary_rows)
-
-        with st.container():
-            st.markdown("<div class='invoice-card'>", unsafe_allow_html=True)
-            st.subheader("3. Review & Export Findings")
-            st.dataframe(df, use_container_width=True, hide_index=True)
-
-            col_download, col_save = st.columns([1, 1])
-            with col_download:
-                st.download_button(
-                    "Download as CSV",
-                    df.to_csv(index=False),
-                    "invoice_tariff_summary.csv",
-                    type="primary",
-                )
-            with col_save:
-                if st.button("Append to internal Excel log", type="secondary"):
-                    combined = append_to_excel_log(df, EXCEL_LOG_PATH)
-                    st.session_state.save_confirmed = True
-                    st.session_state.last_saved = datetime.now()
-                    st.session_state.latest_log = combined
-
-            if st.session_state.get("save_confirmed"):
-                ts = st.session_state.last_saved.strftime("%d %b %Y • %H:%M") if st.session_state.last_saved else ""
-                st.markdown(
-                    f"""
-                    <div class='save-banner'>
-                        ✅ Results appended to the shared Excel log.<br/>
-                        <span style='font-size:0.9rem;'>Saved {ts}. File location: <code>{EXCEL_LOG_PATH}</code></span>
-                    </div>
-                    """,
-                    unsafe_allow_html=True,
-                )
-                with st.expander("View aggregated Excel log", expanded=False):
-                    log_df = st.session_state.get("latest_log")
-                    if log_df is not None:
-                        st.dataframe(log_df, use_container_width=True, hide_index=True)
-            st.markdown("</div>", unsafe_allow_html=True)
-
-        col1, col2 = st.columns(2)
-        with col1:
-            st.markdown("### Manual HS Lookups")
-            st.write("Use the Bahamas Customs tariff search for confirmation and duty rate checks.")
-            st.link_button(
-                "Open Bahamas Tariff Search",
-                "https://www.bahamascustoms.gov.bs/tariffs-and-various-taxes-collected-by-customs/tariff-search/",
-                type="primary",
-            )
-        with col2:
-            st.markdown("### Research Tips")
-            st.markdown(
-                "- Validate descriptions using manufacturer websites.\n"
-                "- Cross-check HS codes with recent rulings.\n"
-                "- Capture duty rate notes in the Excel log after review."
-            )
+    # Reruns keep the upload, so an upload is only handed to queue_hts_batch once, even after its job is dismissed.
+    job = st.session_state.hts_batch_uploads.get(uploaded_file.file_id)
+    if job is None and line_items and hts_via_batch:
+        job = {"id": None, "files": {"realtime": uploaded_file.name}, "line_items": line_items, "warnings": []}
+        try:
+            queue_hts_batch(job)
+        except Exception as e:
+            st.error(f"Submitting the HTS batch job failed: {e}")
+            job = None
+        else:
+            st.session_state.hts_batch_uploads[uploaded_file.file_id] = job
+            if job["hts_rows"]:
+                st.session_state.pending_batches.append(job)
+    if job is not None and any(pending is job for pending in st.session_state.pending_batches):
+        st.success(f"HTS classification of this invoice went to batch {job['id']}. "
+                   "Its findings are shown under the batch status below once the batch completes.")
+    elif line_items:
+        hts_by_pair = dict(zip(job["hts_pairs"], job["hts_codes"])) if job is not None else None
+        render_findings(summarize_line_items(line_items, hts_by_pair))
+        render_research_links()
     else:
         st.warning("No line items found. Please check your invoice or try another file.")
 
+if st.session_state.pending_batches:
+    st.button("Refresh batch status")
+    render_batch_jobs()
+
 st.markdown("---")
 st.caption("For internal customs brokerage use only. Ensure compliance with Bahamas Customs regulations.")
 